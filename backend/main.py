@@ -1,13 +1,24 @@
 import os
+import re
+import math
 import uuid
+import asyncio
+import queue
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from typing import Optional, List
 
 import fitz  # PyMuPDF
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from sqlalchemy import create_engine, String, DateTime, Boolean, ForeignKey, Integer
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base, Mapped, mapped_column, relationship, Session
 from fpdf import FPDF
 
@@ -19,6 +30,8 @@ except Exception as e:  # pragma: no cover
 
 APP_NAME = "AI Hukum MVP Backend"
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title=APP_NAME)
 
 # CORS
@@ -95,6 +108,177 @@ def get_db() -> Session:
         db.close()
 
 
+# Optional write-behind persistence for chat history & feedback.
+# When enabled, endpoints enqueue ORM rows (with pre-generated IDs) and return immediately;
+# a background writer commits them in batched transactions. Queue is drained on shutdown.
+WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "").strip().lower() in {"1", "true", "on", "yes"}
+# Clamped: maxsize <= 0 would make the queue unbounded, and a zero interval busy-spins the writer
+WRITE_BEHIND_QUEUE_SIZE = max(1, int(os.getenv("DB_WRITE_BEHIND_QUEUE_SIZE", "1000")))
+WRITE_BEHIND_BATCH = max(1, int(os.getenv("DB_WRITE_BEHIND_BATCH", "50")))
+WRITE_BEHIND_INTERVAL = max(0.05, float(os.getenv("DB_WRITE_BEHIND_INTERVAL", "0.5")))
+WRITE_BEHIND_RETRIES = max(1, int(os.getenv("DB_WRITE_BEHIND_RETRIES", "5")))
+
+_write_queue: "queue.Queue[Optional[list]]" = queue.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+_writer_thread: Optional[threading.Thread] = None
+_writer_cond = threading.Condition()
+_writer_stopping = False
+_pending_puts = 0  # producers currently inside _write_queue.put()
+
+
+def _commit_rows(rows: list) -> None:
+    db = SessionLocal()
+    try:
+        db.add_all(rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _row_ids(rows: list) -> List[str]:
+    return [f"{type(row).__name__}:{getattr(row, 'id', None)}" for row in rows]
+
+
+def _write_batch(batch: List[list]) -> None:
+    try:
+        _commit_rows([row for rows in batch for row in rows])
+        return
+    except Exception:
+        pass
+    # Retry per item with backoff so one bad row doesn't drop the whole batch
+    # and transient errors (e.g. SQLite "database is locked") don't lose data
+    for rows in batch:
+        delay = 0.1
+        for attempt in range(1, WRITE_BEHIND_RETRIES + 1):
+            try:
+                _commit_rows(rows)
+                break
+            except IntegrityError as e:
+                logger.error("Data write-behind ditolak database, dibuang %s: %s", _row_ids(rows), e)
+                break
+            except Exception as e:
+                if attempt == WRITE_BEHIND_RETRIES:
+                    logger.error("Gagal menyimpan data write-behind setelah %d percobaan, dibuang %s: %s", attempt, _row_ids(rows), e)
+                    break
+                logger.warning("Gagal menyimpan data write-behind (percobaan %d), dicoba lagi: %s", attempt, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+
+def _writer_loop() -> None:
+    stopping = False
+    while not stopping:
+        try:
+            item = _write_queue.get(timeout=WRITE_BEHIND_INTERVAL)
+        except queue.Empty:
+            continue
+        batch: List[list] = []
+        if item is None:
+            stopping = True
+        else:
+            batch.append(item)
+        while len(batch) < WRITE_BEHIND_BATCH:
+            try:
+                item = _write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                continue
+            batch.append(item)
+        if batch:
+            _write_batch(batch)
+    # Drain anything enqueued before the stop sentinel was processed
+    rest: List[list] = []
+    while True:
+        try:
+            item = _write_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not None:
+            rest.append(item)
+    if rest:
+        _write_batch(rest)
+
+
+def _drain_queue_sync() -> None:
+    # Writer thread is gone: commit whatever it left behind so later rows don't overtake it
+    rest: List[list] = []
+    while True:
+        try:
+            item = _write_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not None:
+            rest.append(item)
+    if rest:
+        _write_batch(rest)
+
+
+def persist(db: Session, rows: list) -> None:
+    """Save rows now, or hand them to the background writer in write-behind mode.
+
+    Rows must carry their own IDs. A full queue blocks the caller (backpressure) so
+    writes stay in order; once shutdown has started, or if the writer thread died,
+    rows are committed synchronously after everything queued before them.
+    """
+    global _pending_puts
+    if WRITE_BEHIND:
+        while True:
+            with _writer_cond:
+                thread = _writer_thread
+                if _writer_stopping or thread is None:
+                    break
+                if not thread.is_alive():
+                    logger.error("Writer write-behind mati, beralih ke penyimpanan sinkron")
+                    _drain_queue_sync()
+                    thread = None
+                    break
+                _pending_puts += 1
+            try:
+                _write_queue.put(rows, timeout=WRITE_BEHIND_INTERVAL)
+                return
+            except queue.Full:
+                pass
+            finally:
+                with _writer_cond:
+                    _pending_puts -= 1
+                    _writer_cond.notify_all()
+        if thread is not None:
+            thread.join()
+    db.add_all(rows)
+    db.commit()
+
+
+@app.on_event("startup")
+def start_writer() -> None:
+    global _writer_thread, _writer_stopping
+    with _writer_cond:
+        if WRITE_BEHIND and _writer_thread is None:
+            _writer_stopping = False
+            _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _writer_thread.start()
+
+
+@app.on_event("shutdown")
+def stop_writer() -> None:
+    global _writer_thread, _writer_stopping
+    # No producer can start a put once the flag is set; wait for in-flight puts
+    # so the sentinel is guaranteed to be the last item
+    with _writer_cond:
+        _writer_stopping = True
+        thread = _writer_thread
+        _writer_cond.wait_for(lambda: _pending_puts == 0)
+    if thread is not None and thread.is_alive():
+        _write_queue.put(None)
+        thread.join()
+    else:
+        _drain_queue_sync()
+    _writer_thread = None
+
+
 class SummarizeRequest(BaseModel):
     session_id: str
     lang: Optional[str] = None  # 'id' or 'en'
@@ -115,17 +299,257 @@ class DraftRequest(BaseModel):
     lang: Optional[str] = None  # 'id' or 'en'
 
 
+def pdf_to_text(pdf_bytes: bytes) -> str:
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        texts: list[str] = []
+        for page in doc:
+            texts.append(page.get_text())
+        return "\n".join(texts).strip()
+
+
 def extract_text_from_pdf(pdf_bytes: bytes) -> str:
     try:
-        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            texts: list[str] = []
-            for page in doc:
-                texts.append(page.get_text())
-            return "\n".join(texts).strip()
+        return pdf_to_text(pdf_bytes)
     except Exception as e:  # pragma: no cover
         raise HTTPException(status_code=400, detail=f"Gagal membaca PDF: {e}")
 
 
+# PyMuPDF is not thread-safe and holds the GIL, so multi-file PDF extraction
+# runs in a process pool (spawned, so each worker has its own MuPDF state).
+# ANALYZE_PDF_WORKERS <= 1 disables the pool and extracts sequentially.
+ANALYZE_PDF_WORKERS = int(os.getenv("ANALYZE_PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+
+def get_pdf_pool() -> Optional[ProcessPoolExecutor]:
+    global _pdf_pool
+    if ANALYZE_PDF_WORKERS <= 1:
+        return None
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=ANALYZE_PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+
+@app.on_event("shutdown")
+def stop_pdf_pool() -> None:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=True)
+            _pdf_pool = None
+
+
+# Prompt budgeting for multi-file /analyze
+ANALYZE_PROMPT_BUDGET = int(os.getenv("ANALYZE_PROMPT_BUDGET", "15000"))
+SECTION_MAX_CHARS = 1500
+SECTION_HEADING_RE = re.compile(
+    r"^\s*((pasal|ayat|bab|bagian|article|section|clause|klausul|lampiran|annex|schedule)\b|\d+(\.\d+)*[.)]\s)",
+    re.IGNORECASE,
+)
+LEGAL_KEYWORDS_RE = re.compile(
+    r"\b(pasal|ayat|pihak|kewajiban|hak|sanksi|denda|ganti rugi|jangka waktu|pembayaran|pengakhiran|wanprestasi|"
+    r"keadaan memaksa|force majeure|sengketa|yurisdiksi|kerahasiaan|jaminan|tanggung jawab|"
+    r"party|parties|obligation|liabilit\w*|indemn\w*|termination|payment|penalt\w*|breach|governing law|"
+    r"dispute|confidential\w*|warrant\w*|term)\b",
+    re.IGNORECASE,
+)
+NUMBER_RE = re.compile(r"\d+")
+SENTENCE_END_RE = re.compile(r"[.;:!?](?=\s)")
+GAP_MARKER = "\n[...]\n"
+MIN_PARTIAL_CHARS = 100  # don't bother filling leftover budget with tinier fragments
+ANALYZE_MIN_FILE_CHARS = 500  # minimum prompt share per document
+LABEL_MAX_CHARS = 80
+
+
+def is_pdf_upload(name: str, ctype: str) -> bool:
+    return "pdf" in (ctype or "").lower() or (name or "").lower().endswith(".pdf")
+
+
+def decode_upload(name: str, ctype: str, data: bytes) -> Optional[str]:
+    """Extract text from a PDF/TXT upload; returns None for unsupported types."""
+    if is_pdf_upload(name, ctype):
+        return extract_text_from_pdf(data)
+    if "text" in (ctype or "").lower() or (name or "").lower().endswith(".txt"):
+        try:
+            return data.decode("utf-8", errors="ignore")
+        except Exception:
+            return data.decode("latin-1", errors="ignore")
+    return None
+
+
+async def extract_uploads(uploads: List[tuple[str, str, bytes]]) -> List[Optional[str]]:
+    """Extract text from (name, content_type, data) uploads; PDFs in parallel when possible."""
+    pool = get_pdf_pool()
+    if pool is None or sum(is_pdf_upload(name, ctype) for name, ctype, _ in uploads) < 2:
+        # Nothing to parallelize: one threadpool call keeps the event loop free
+        return await run_in_threadpool(lambda: [decode_upload(name, ctype, data) for name, ctype, data in uploads])
+
+    loop = asyncio.get_running_loop()
+
+    async def extract_one(name: str, ctype: str, data: bytes) -> Optional[str]:
+        if not is_pdf_upload(name, ctype):
+            return decode_upload(name, ctype, data)
+        try:
+            return await loop.run_in_executor(pool, pdf_to_text, data)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Gagal membaca PDF: {e}")
+
+    return list(await asyncio.gather(*(extract_one(name, ctype, data) for name, ctype, data in uploads)))
+
+
+def allocate_budget(sizes: List[int], budget: int) -> List[int]:
+    """Split a character budget fairly across documents.
+
+    Each document gets an equal share; whatever a short document doesn't use
+    is redistributed to the longer ones.
+    """
+    alloc = [0] * len(sizes)
+    remaining = budget
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for pos, i in enumerate(order):
+        share = remaining // (len(sizes) - pos)
+        alloc[i] = min(sizes[i], share)
+        remaining -= alloc[i]
+    return alloc
+
+
+def cut_point(text: str, limit: int) -> int:
+    """Index to cut ``text`` at so the prefix fits ``limit``, preferring sentence ends, then spaces."""
+    if len(text) <= limit:
+        return len(text)
+    ends = [m.end() for m in SENTENCE_END_RE.finditer(text, 0, limit + 1)]
+    if ends and ends[-1] >= limit // 2:
+        return ends[-1]
+    space = text.rfind(" ", 0, limit)
+    if space >= limit // 2:
+        return space
+    return limit
+
+
+def split_long_line(line: str, max_chars: int) -> List[str]:
+    chunks: List[str] = []
+    while len(line) > max_chars:
+        cut = cut_point(line, max_chars)
+        chunks.append(line[:cut].rstrip())
+        line = line[cut:].lstrip()
+    if line:
+        chunks.append(line)
+    return chunks
+
+
+def split_sections(text: str) -> List[str]:
+    sections: List[str] = []
+    current: List[str] = []
+    size = 0
+    for raw_line in text.splitlines():
+        if not raw_line.strip():
+            if current:
+                sections.append("\n".join(current).strip())
+                current, size = [], 0
+            continue
+        # Whole paragraphs often sit on one line; chunk them so sections stay packable.
+        # Half-size chunks leave room for a heading line in the same section.
+        for line in split_long_line(raw_line, SECTION_MAX_CHARS // 2):
+            if current and (SECTION_HEADING_RE.match(line) or size + len(line) > SECTION_MAX_CHARS):
+                sections.append("\n".join(current).strip())
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+    if current:
+        sections.append("\n".join(current).strip())
+    return [sec for sec in sections if sec]
+
+
+def section_score(section: str, index: int) -> float:
+    # Opening section usually names the parties and the subject; always keep it if it fits
+    if index == 0:
+        return math.inf
+    hits = len(LEGAL_KEYWORDS_RE.findall(section)) * 2 + len(NUMBER_RE.findall(section))
+    if SECTION_HEADING_RE.match(section):
+        hits += 3
+    return hits / math.sqrt(len(section))
+
+
+def select_sections(text: str, limit: int) -> tuple[str, int]:
+    """Pick the most informative sections of ``text`` within ``limit`` chars, in document order.
+
+    Leftover budget is filled with a prefix of the best skipped section, and every
+    omission (including a cut-off end) is marked with ``[...]``. Returns the prompt
+    part and the number of document characters it contains (excluding markers).
+    """
+    if len(text) <= limit:
+        return text, len(text)
+    sections = split_sections(text)
+    ranked = sorted(range(len(sections)), key=lambda i: -section_score(sections[i], i))
+    gap = len(GAP_MARKER)
+    # Every chosen section pays for one marker; the extra one covers a leading/trailing marker
+    used = gap
+    chosen: List[int] = []
+    for i in ranked:
+        cost = len(sections[i]) + gap
+        if used + cost <= limit:
+            chosen.append(i)
+            used += cost
+    texts = {i: sections[i] for i in chosen}
+    partial: Optional[int] = None
+    room = limit - used - gap
+    if room >= MIN_PARTIAL_CHARS:
+        for i in ranked:
+            if i not in texts:
+                prefix = sections[i][: cut_point(sections[i], room)].rstrip()
+                if prefix:
+                    texts[i] = prefix
+                    partial = i
+                break
+    if not texts:
+        return "", 0
+    order = sorted(texts)
+    out: List[str] = [] if order[0] == 0 else ["[...]\n"]
+    for pos, i in enumerate(order):
+        if pos > 0:
+            prev = order[pos - 1]
+            out.append(GAP_MARKER if i != prev + 1 or prev == partial else "\n\n")
+        out.append(texts[i])
+    if order[-1] != len(sections) - 1 or order[-1] == partial:
+        out.append("\n[...]")
+    return "".join(out), sum(len(t) for t in texts.values())
+
+
+def unique_labels(names: List[str]) -> List[str]:
+    """Shorten names to LABEL_MAX_CHARS and suffix duplicates so every document label is distinct."""
+    labels: List[str] = []
+    taken: set[str] = set()
+    for name in names:
+        base = name[:LABEL_MAX_CHARS]
+        label, n = base, 1
+        while label in taken:
+            n += 1
+            label = f"{base} ({n})"
+        taken.add(label)
+        labels.append(label)
+    return labels
+
+
+def budget_documents(docs: List[tuple[str, str]], budget: int) -> List[tuple[str, int]]:
+    """Select each document's prompt part within its fair share of ``budget``.
+
+    Budget a document leaves unused (e.g. because its sections don't pack exactly)
+    is handed to the documents that were cut in a second pass.
+    """
+    limits = allocate_budget([len(t) for _, t in docs], budget)
+    parts = [select_sections(t, limit) for (_, t), limit in zip(docs, limits)]
+    spare = sum(limit - len(part) for limit, (part, _) in zip(limits, parts))
+    cut = [i for i, (_, t) in enumerate(docs) if parts[i][1] < len(t)]
+    if spare > 0 and cut:
+        extra = allocate_budget([len(docs[i][1]) - len(parts[i][0]) for i in cut], spare)
+        for i, more in zip(cut, extra):
+            if more > 0:
+                parts[i] = select_sections(docs[i][1], limits[i] + more)
+    return parts
+
+
 def get_client() -> Anthropic:
     api_key = os.getenv("ANTHROPIC_API_KEY")
     if not api_key:
@@ -268,33 +692,38 @@ async def analyze(
     lang: Optional[str] = Form(None),  # 'id' or 'en'
     db: Session = Depends(get_db),
 ):
-    combined_text_parts: List[str] = []
+    docs: List[tuple[str, str]] = []  # (label, text)
 
-    # Process files
+    # Process files: read uploads, then extract them (PDFs in parallel via the process pool)
     if files:
-        for f in files:
-            content = await f.read()
-            if not content:
-                continue
-            name_lower = (f.filename or "").lower()
-            ctype = (f.content_type or "").lower()
-            is_pdf = "pdf" in ctype or name_lower.endswith(".pdf")
-            is_txt = "text" in ctype or name_lower.endswith(".txt")
-            if is_pdf:
-                combined_text_parts.append(extract_text_from_pdf(content))
-            elif is_txt:
-                try:
-                    combined_text_parts.append(content.decode("utf-8", errors="ignore"))
-                except Exception:
-                    combined_text_parts.append(content.decode("latin-1", errors="ignore"))
+        uploads = [(f.filename or f"file_{i + 1}", f.content_type or "", await f.read()) for i, f in enumerate(files)]
+        uploads = [u for u in uploads if u[2]]
+        texts = await extract_uploads(uploads)
+        for (name, _, _), extracted in zip(uploads, texts):
+            if extracted and extracted.strip():
+                docs.append((name, extracted.strip()))
 
     if text and text.strip():
-        combined_text_parts.append(text.strip())
+        docs.append(("text", text.strip()))
 
-    combined_text = "\n\n---\n\n".join([p for p in combined_text_parts if p]).strip()
-    if not combined_text:
+    if not docs:
         raise HTTPException(status_code=400, detail="Tidak ada input untuk dianalisa")
 
+    docs = list(zip(unique_labels([name for name, _ in docs]), [doc_text for _, doc_text in docs]))
+
+    # Give every document a fair share of the prompt instead of truncating the joined text
+    label_overhead = sum(len(f"=== {name} ===\n") + len("\n\n---\n\n") for name, _ in docs)
+    content_budget = ANALYZE_PROMPT_BUDGET - label_overhead
+    if content_budget < ANALYZE_MIN_FILE_CHARS * len(docs):
+        raise HTTPException(status_code=400, detail="Terlalu banyak file untuk dianalisa sekaligus")
+    parts = budget_documents(docs, content_budget)
+    combined_text_parts: List[str] = []
+    coverage: List[dict] = []
+    for (name, doc_text), (part, included) in zip(docs, parts):
+        combined_text_parts.append(f"=== {name} ===\n{part}")
+        coverage.append({"name": name, "chars_included": included, "chars_total": len(doc_text)})
+    combined_text = "\n\n---\n\n".join(combined_text_parts)
+
     language = (lang or "id").lower()
     mode = (preset or "summary").lower()
 
@@ -332,7 +761,7 @@ async def analyze(
     instruction = instruction_map.get(mode, instruction_map["summary"])
     prompt = (
         f"{assistant_intro} {instruction} {citations_line} {schema_line} {lang_intro}\n\n"
-        f"{document_label}:\n{combined_text[:15000]}\n\n{output_only}"
+        f"{document_label}:\n{combined_text}\n\n{output_only}"
     )
     raw = call_claude(prompt, max_tokens=900, temperature=0.2)
     import json
@@ -347,25 +776,30 @@ async def analyze(
     chat_id: Optional[str] = None
     assistant_message_id: Optional[str] = None
     if not is_confidential:
-        chat = Chat(title="Analisa Dokumen", confidential=False)
-        db.add(chat)
-        db.flush()
-        chat_id = chat.id
-        user_msg = Message(chat_id=chat.id, role="user", content=f"[{mode}/{language}]\n" + combined_text[:15000])
-        db.add(user_msg)
-        assistant_msg = Message(chat_id=chat.id, role="assistant", content=(parsed.get("summary") or raw))
-        db.add(assistant_msg)
-        db.flush()
-        assistant_message_id = assistant_msg.id
+        # IDs are generated up front so the response doesn't depend on a flush
+        now = datetime.utcnow()
+        chat_id = str(uuid.uuid4())
+        assistant_message_id = str(uuid.uuid4())
+        rows: list = [
+            Chat(id=chat_id, title="Analisa Dokumen", confidential=False, created_at=now, updated_at=now),
+            Message(id=str(uuid.uuid4()), chat_id=chat_id, role="user", content=f"[{mode}/{language}]\n" + combined_text, created_at=now),
+            Message(id=assistant_message_id, chat_id=chat_id, role="assistant", content=(parsed.get("summary") or raw), created_at=datetime.utcnow()),
+        ]
         # Save file names metadata
         if files:
             for f in files:
                 if f and f.filename:
-                    db.add(FileRec(chat_id=chat.id, name=f.filename))
-        chat.updated_at = datetime.utcnow()
-        db.commit()
+                    rows.append(FileRec(id=str(uuid.uuid4()), chat_id=chat_id, name=f.filename, created_at=now))
+        # May block on a full write-behind queue; keep that off the event loop
+        await run_in_threadpool(persist, db, rows)
 
-    return {"result": parsed.get("summary") or parsed, "details": parsed, "chat_id": chat_id, "assistant_message_id": assistant_message_id}
+    return {
+        "result": parsed.get("summary") or parsed,
+        "details": parsed,
+        "chat_id": chat_id,
+        "assistant_message_id": assistant_message_id,
+        "coverage": coverage,
+    }
 
 
 @app.post("/draft")
@@ -481,9 +915,8 @@ def export_docx(chat_id: str = Form(...), db: Session = Depends(get_db)):
 def feedback(chat_id: Optional[str] = Form(None), message_id: Optional[str] = Form(None), value: int = Form(...), comment: Optional[str] = Form(None), db: Session = Depends(get_db)):
     if value not in (-1, 1):
         raise HTTPException(status_code=400, detail="value harus -1 atau 1")
-    fb = Feedback(chat_id=chat_id, message_id=message_id, value=value, comment=comment)
-    db.add(fb)
-    db.commit()
+    fb = Feedback(id=str(uuid.uuid4()), chat_id=chat_id, message_id=message_id, value=value, comment=comment, created_at=datetime.utcnow())
+    persist(db, [fb])
     return {"ok": True}
 
 